@@ -3,25 +3,450 @@ __author__ = 'bloomj'
 '''
 Created on Feb 9, 2017
 @author: bloomj
+Requires Python 3.
 '''
+import importlib.util
+import os
+import subprocess
+import sys
+
 try:
     import docloud
-except:
-    if hasattr(sys, 'real_prefix'):
+except ImportError:
+    if sys.prefix != sys.base_prefix:
         # we are in a virtual env.
-        !pip install docloud
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'docloud'])
     else:
-        !pip install - -user docloud
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--user', 'docloud'])
 
-from docloud.job import JobClient
+from docloud.job import JobClient, JobAttachmentInfo, DOcloudException, DOcloudInterruptedException, \
+    DOcloudNotFoundError, DOcloudForbiddenError
 from docloud.status import JobSolveStatus, JobExecutionStatus
 
-from urlparse import urlparse
+from urllib.parse import urlparse
+from urllib.request import urlopen
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    import httpx
+except ImportError:  # HTTP/2 is optional; the requests session of JobClient is used instead
+    httpx = None
+if importlib.util.find_spec("h2") is None:  # needed by httpx for HTTP/2
+    httpx = None
 
-import fileinput
-import urllib
-import cStringIO
+import atexit
+import contextlib
+import functools
+import hashlib
+import io
+import shutil
+import ssl
+import threading
+import time
+from gzip import GzipFile
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared connection pool for reading model and data files, so that files on the same host reuse one connection
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# The failures of a request to the solve service or of the read of a file, whichever transport is used
+# (requests.RequestException is an IOError)
+_requestErrors = (DOcloudException, IOError) if httpx is None else (DOcloudException, IOError, httpx.HTTPError)
+
+
+def _isHTTP(url):
+    '''
+     @return true if the URL is read over the shared connection pool (http and https); false if it is read with urlopen (file and others)
+    '''
+    return urlparse(url).scheme in ("http", "https")
+
+
+def _openURL(url):
+    '''
+     Opens a URL for reading, over the shared connection pool if it is an http or https URL.
+     The body is streamed rather than downloaded up front.
+     @param url: the location of the file
+     @type url: URL
+     @return a file
+     @raise requests.HTTPError or IOError if the file cannot be retrieved
+    '''
+    if not _isHTTP(url):
+        return urlopen(url)
+    response = _http.get(url, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return response.raw
+
+
+def _readURL(url):
+    '''
+     Reads the whole contents of a URL, over the shared connection pool if it is an http or https URL.
+     @param url: the location of the file
+     @type url: URL
+     @return the contents of the file, as bytes
+     @raise requests.HTTPError or IOError if the file cannot be retrieved
+    '''
+    if not _isHTTP(url):
+        stream = urlopen(url)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+    response = _http.get(url)
+    response.raise_for_status()
+    return response.content
+
+
+# The connections kept to DOcplexcloud per host, and so the default number of jobs that solveMany and gather handle at once,
+# so that concurrent requests reuse the pooled connections instead of opening new ones
+_POOL_SIZE = 50
+
+# Set to False before the first Optimizer is created to keep the requests session of JobClient even when httpx is installed
+USE_HTTP2 = True
+
+
+class _JobClient(JobClient):
+    '''
+     A DOcplexcloud client that compresses uploaded attachments in memory at the fastest compression level.
+     The base client compresses at the slowest level, through a temporary file, although it is the upload
+     rather than the compression that limits the turnaround of a solve.
+     When httpx is installed and USE_HTTP2 is set, all the requests of the client are multiplexed over a single HTTP/2 connection.
+    '''
+
+    def __init__(self, url, api_key, **kwargs):
+        super(_JobClient, self).__init__(url, api_key, **kwargs)
+        # Keeps the connections to DOcplexcloud alive from solve to solve, so that upload, polling, and deletion
+        # in a decomposition algorithm do not pay a new TLS handshake on each iteration
+        if USE_HTTP2 and httpx is not None and "proxies" not in self.requests_options:
+            self.session.close()
+            self.session = _HTTP2Session(self.session.headers)
+        else:
+            self.session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=_POOL_SIZE, max_retries=3))
+
+    def upload_job_attachment(self, jobid, attid, file=None, data=None, filename=None, timeout=None, gzip=False):
+        if not gzip:
+            return super(_JobClient, self).upload_job_attachment(jobid, attid, file=file, data=data,
+                                                                 filename=filename, timeout=timeout)
+        att = JobAttachmentInfo({'name': attid}, file=file, data=data, filename=filename)
+        compressed = io.BytesIO()
+        try:
+            with GzipFile(fileobj=compressed, mode="wb", compresslevel=1) as z:
+                if att.file is not None:
+                    shutil.copyfileobj(att.file, z, 65536)
+                else:
+                    z.write(att.get_data())
+        finally:
+            att.close_file()
+        compressed.seek(0)
+        url = '{base_url}/jobs/{jobid}/attachments/{attid}/blob'.format(base_url=self.url, jobid=jobid, attid=attid)
+        response = self._put(url, data=compressed, timeout=timeout, gzip=True)  # sent with Content-Encoding: gzip
+        self._check_ok_no_content(response)
+
+    def download_job_log_tail(self, jobid, size=65536, timeout=None):
+        '''
+         Downloads the end of the job log, which is where a solver reports how the solve ended,
+         without transferring the whole log.
+         @param jobid: the id of the job
+         @type jobid: String
+         @param size: the number of bytes to download
+         @type size: int
+         @return the last size bytes of the log
+        '''
+        url = '{base_url}/jobs/{jobid}/log/blob'.format(base_url=self.url, jobid=jobid)
+        headers = dict(self._base_headers)
+        headers['Range'] = 'bytes=-' + str(size)
+        response = self._request('GET', url, headers=headers, verify=self.verify, timeout=timeout,
+                                 **self.requests_options)
+        self._check_status(response, [200, 206])  # 200 if the server ignores the range and sends the whole log
+        return response.content[-size:]
+
+    # end class _JobClient
+
+
+class _HTTP2Session(object):
+    '''
+     Stands in for the requests session of a JobClient and sends its requests over HTTP/2 with httpx,
+     so that the upload, status, and download requests of a solve share one connection instead of queuing for it.
+     Only the part of the requests API that JobClient uses is provided.
+    '''
+
+    def __init__(self, headers):
+        '''
+         @param headers: the headers to send with every request
+         @type headers: dict<String, String>
+        '''
+        self.headers = dict(headers)
+        self.clients = {}  # httpx clients by TLS verification setting, as JobClient.verify may change after construction
+        self.clientsLock = threading.Lock()
+
+    def request(self, method, url, timeout=None, headers=None, data=None, verify=True, stream=False):
+        if hasattr(data, "read"):  # is a file
+            data = data.read()
+        client = self._getClient(verify)
+        request = client.build_request(method, url, headers=headers, content=data, timeout=timeout)
+        return _HTTP2Response(client.send(request, stream=stream))
+
+    def _getClient(self, verify):
+        '''
+         @param verify: the TLS verification setting, as in requests: a boolean, or the path of a CA bundle file or directory
+         @return the client for that setting, created on first use
+        '''
+        with self.clientsLock:
+            client = self.clients.get(verify)
+            if client is None:
+                context = verify
+                if not isinstance(verify, bool):
+                    if os.path.isdir(verify):
+                        context = ssl.create_default_context(capath=verify)
+                    else:
+                        context = ssl.create_default_context(cafile=verify)
+                transport = httpx.HTTPTransport(http2=True, retries=3, verify=context,
+                                                limits=httpx.Limits(max_connections=10, max_keepalive_connections=10))
+                client = httpx.Client(transport=transport, headers=self.headers, timeout=300)
+                self.clients[verify] = client
+            return client
+
+    def close(self):
+        with self.clientsLock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+    # end class _HTTP2Session
+
+
+class _HTTP2Response(object):
+    '''
+     Presents an httpx response with the part of the requests API that JobClient and Optimizer use.
+    '''
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self._raw = None
+
+    @property
+    def content(self):
+        return self.response.read()
+
+    @property
+    def raw(self):
+        '''
+         @return a file over the decoded body
+        '''
+        if self._raw is None:
+            self._raw = _ChunkStream(self.response.iter_bytes())
+        return self._raw
+
+    def iter_content(self, chunk_size=1):
+        return self.response.iter_bytes(chunk_size)
+
+    def json(self):
+        self.response.read()
+        return self.response.json()
+
+    def close(self):
+        self.response.close()
+
+    # end class _HTTP2Response
+
+
+class _ChunkStream(io.RawIOBase):
+    '''
+     A read-only stream over an iterable of byte strings.
+    '''
+
+    def __init__(self, chunks):
+        '''
+         @param chunks: the contents of the stream, in order
+         @type chunks: iterable<bytes>
+        '''
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b""
+                return 0
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    # end class _ChunkStream
+
+
+# DOcplexcloud clients by (url, key), shared by all the Optimizer instances with the same credentials,
+# so that the subproblems of a decomposition algorithm share one connection pool
+_jobClients = {}
+_jobClientsLock = threading.Lock()
+
+
+def _getJobClient(url, key):
+    '''
+     Returns the DOcplexcloud client for the given credentials, creating it on first use.
+     @param url: the DOcplexcloud url
+     @type url: String
+     @param key: the DOcplexcloud api key
+     @type key: String
+     @return the shared client
+    '''
+    with _jobClientsLock:
+        jobclient = _jobClients.get((url, key))
+        if jobclient is None:
+            jobclient = _JobClient(url, key)
+            _jobClients[(url, key)] = jobclient
+        return jobclient
+
+
+@atexit.register
+def _closeJobClients():
+    '''
+     Closes the connections held by the shared DOcplexcloud clients.
+     The clients are kept open for the life of the process and released only here.
+    '''
+    with _jobClientsLock:
+        for jobclient in _jobClients.values():
+            jobclient.close()
+        _jobClients.clear()
+
+
+# Runs the deletion of finished jobs off the critical path of solve.
+# Registered after _closeJobClients, so that at exit the pending deletions finish before the clients are closed.
+_cleanupPool = ThreadPoolExecutor(max_workers=2)
+atexit.register(_cleanupPool.shutdown, wait=True)
+
+
+def _deleteJobInBackground(jobclient, jobid, kill=False):
+    '''
+     Deletes a job from the solve service on the cleanup pool.
+     A failed deletion is reported, since it no longer reaches the caller and the job would otherwise stay on the service unnoticed.
+     @param jobclient: the client of the job
+     @param jobid: the id of the job
+     @type jobid: String
+     @param kill: if True, the job is killed first, since deleting a job that may still be running does not stop it
+     @type kill: boolean
+    '''
+    if kill:
+        future = _cleanupPool.submit(_killAndDeleteJob, jobclient, jobid)
+    else:
+        future = _cleanupPool.submit(jobclient.delete_job, jobid)
+    future.add_done_callback(functools.partial(_reportDeletion, jobid))
+
+
+def _killAndDeleteJob(jobclient, jobid):
+    '''
+     Kills a job that may still be running and deletes it.
+     @param jobclient: the client of the job
+     @param jobid: the id of the job
+     @type jobid: String
+     @return true if the job was deleted
+    '''
+    try:
+        jobclient.kill_job(jobid)
+    except DOcloudException:
+        pass  # the job has ended in the meantime; the deletion reports any other problem
+    return jobclient.delete_job(jobid)
+
+
+def _reportDeletion(jobid, future):
+    '''
+     Reports the deletion of a job if it failed.
+     @param jobid: the id of the job
+     @type jobid: String
+     @param future: the outcome of the deletion
+     @type future: concurrent.futures.Future
+    '''
+    exception = future.exception()
+    if exception is not None:
+        print("Could not delete job " + jobid + ": " + str(exception))
+    elif not future.result():
+        print("Could not delete job " + jobid)
+
+
+class _TemplateJob(object):
+    '''
+     A job, never executed, that holds the model and constant data of a problem on the solve service.
+     Its lock serializes the upload of the job, so that other problems do not wait for it.
+    '''
+
+    def __init__(self, jobclient):
+        self.jobclient = jobclient
+        self.lock = threading.Lock()
+        self.jobid = None  # until the second submit of the problem
+        self.copyable = True  # until the solve service answers that it does not support the copy
+
+    # end class _TemplateJob
+
+
+# Template jobs by (url, key, model name, model digest, attachments).
+# The global lock only guards the dictionary; each template is uploaded under its own lock.
+_templateJobs = {}
+_templateJobsLock = threading.Lock()
+
+# Statuses with which the solve service answers a shallow copy that it does not support.
+# Other failures, such as an overloaded service, are not a reason to stop using the template.
+_COPY_UNSUPPORTED_STATUSES = (404, 405)
+
+
+def _httpStatus(exception):
+    '''
+     @param exception: a failure of a DOcplexcloud request
+     @type exception: DOcloudException
+     @return the HTTP status of the failed request, or None if it is not known
+    '''
+    if isinstance(exception, DOcloudNotFoundError):
+        return 404
+    if isinstance(exception, DOcloudForbiddenError):
+        return 403
+    # JobClient._check_status raises other failures with a message of the form "<status>: <message>"
+    status = str(exception).split(":", 1)[0]
+    return int(status) if status.isdigit() else None
+
+
+@atexit.register
+def _deleteTemplateJobs():
+    '''
+     Deletes the template jobs from the solve service.
+     Registered after _closeJobClients, so that at exit it runs while the clients are still open.
+    '''
+    with _templateJobsLock:
+        for templateJob in _templateJobs.values():
+            if templateJob.jobid is not None:
+                try:
+                    templateJob.jobclient.delete_job(templateJob.jobid)
+                except DOcloudException as e:
+                    print("Could not delete job " + templateJob.jobid + ": " + str(e))
+        _templateJobs.clear()
+
+
+# Jobs of the lazy solves whose solution has not been downloaded yet, as (client, job id)
+_lazyJobs = set()
+_lazyJobsLock = threading.Lock()
+
+
+@atexit.register
+def _deleteLazyJobs():
+    '''
+     Deletes from the solve service the jobs of the lazy solves whose solution was never requested.
+     Registered after _closeJobClients, so that at exit it runs while the clients are still open.
+    '''
+    with _lazyJobsLock:
+        for jobclient, jobid in _lazyJobs:
+            try:
+                jobclient.delete_job(jobid)
+            except DOcloudException as e:
+                print("Could not delete job " + jobid + ": " + str(e))
+        _lazyJobs.clear()
 
 
 class Optimizer(object):
@@ -44,7 +469,7 @@ class Optimizer(object):
      This class is completely independent of the specific optimization problem to be solved.
     '''
 
-    def __init__(self, problemName, model=None, resultDataModel=None, credentials=None, *attachments):
+    def __init__(self, problemName, model=None, resultDataModel=None, credentials=None, *attachments, debug=False):
         '''
          Constructs an Optimizer instance.
          The instance requires an optimization model as a parameter.
@@ -60,17 +485,22 @@ class Optimizer(object):
          :type credentials: {"url":String, "key":String}
          :param attachments: URLs for files representing the data that does not vary from solve to solve
          :type attachments: list<URL>
+         :param debug: if True, solve saves the tail of the solver log to solver.log
+         :type debug: boolean
         '''
         self.name = problemName
+        self.debug = debug
         self.model = model
         self.resultDataModel = resultDataModel
         self.attachData(attachments)
-        self.streamsRegistry = []
         self.history = []
+        self._solution = None
+        self.solveStatuses = []
+        self._lazySolution = None  # (jobid, solutionId) of a lazy solve whose solution has not been downloaded yet
 
         self.credentials = credentials
 
-        self.jobclient = JobClient(credentials["url"], credentials["key"]);
+        self.jobclient = _getJobClient(credentials["url"], credentials["key"]);
         self.solveStatus = JobSolveStatus.UNKNOWN;
 
     def getName(self):
@@ -129,78 +559,370 @@ class Optimizer(object):
         self.attachments = {}
         if attachments is not None:
             for f in attachments:
-                fileName = os.path.splitext(os.path.basename(urlparse(f)))[0]
+                fileName = os.path.splitext(os.path.basename(urlparse(f).path))[0]
                 if fileName in self.attachments:
                     raise ValueError(fileName + " already attached")
                 self.attachments[fileName] = f
         return self;
 
-    def solve(self, inputData=None, solutionId=""):
+    def solve(self, inputData=None, solutionId="", lazy=False):
         '''
         Solves an optimization problem instance by calling the DOCloud solve service (Oaas).
         Creates a new job request, incorporating any changes to the variable input data,
         for a problem instance to be processed by the solve service.
         Once the problem is solved, the results are mapped to an instance of an OPL Collector.
         Note: this method will set a new destination for the JSON serialization of the input data.
-        @param inputData: the variable, solve-specific input data
+        @param inputData: the variable, solve-specific input data (None or an empty collector if not used)
         @type inputData: OPLCollector
         @param solutionId: an identifier for the solution, used in iterative algorithms (set to empty string if not needed)
         @type solutionId: String
-        @return: a solution collector
+        @param lazy: if True, returns as soon as the solve status is known and downloads the solution only when getSolution is called
+        or the solution attribute is read, which saves the download when, for example, the caller only needs to check feasibility.
+        The job of a solution that is never requested is deleted by the next call to solve, fetch, or gather, or at exit.
+        @type lazy: boolean
+        @return: a solution collector, or None if lazy
+        '''
+        self._discardLazySolution()
+        self.jobid = self.submit(inputData)
+        solution, self.solveStatus, keptJob = self._fetch(self.jobid, solutionId,
+                                                          log="solver.log" if self.debug else None, lazy=lazy)
+        self._solution = solution
+        if keptJob:
+            self._lazySolution = (self.jobid, solutionId)
+            with _lazyJobsLock:
+                _lazyJobs.add((self.jobclient, self.jobid))
+        elif solution is not None:
+            self.history.append(solution)
+        return solution
+
+    def getSolution(self):
+        '''
+        Returns the solution of the last call to solve.
+        If that solve was lazy, the solution is downloaded from the solve service on the first call and kept afterwards.
+        @return: a solution collector, or None if the last solve did not process successfully
+        '''
+        lazySolution = self._takeLazySolution()
+        if lazySolution is not None:
+            jobid, solutionId = lazySolution
+            try:
+                self._solution = self._loadSolution(jobid, solutionId)
+                self.history.append(self._solution)
+            finally:
+                self._deleteJob(jobid)
+        return self._solution
+
+    @property
+    def solution(self):
+        '''
+        The solution of the last call to solve, as returned by getSolution.
+        '''
+        return self.getSolution()
+
+    def _discardLazySolution(self):
+        '''
+        Deletes the job of a lazy solve whose solution was never requested.
+        '''
+        lazySolution = self._takeLazySolution()
+        if lazySolution is not None:
+            self._deleteJob(lazySolution[0])
+
+    def _takeLazySolution(self):
+        '''
+        Clears the pending lazy solve, if any, and removes its job from the jobs deleted at exit.
+        @return: the job id and the solution id of the lazy solve, or None if there is none
+        '''
+        lazySolution, self._lazySolution = self._lazySolution, None
+        if lazySolution is not None:
+            with _lazyJobsLock:
+                _lazyJobs.discard((self.jobclient, lazySolution[0]))
+        return lazySolution
+
+    def solveMany(self, inputDataList, solutionId="", fanout=_POOL_SIZE):
+        '''
+        Solves several independent instances of this optimization problem concurrently,
+        such as the subproblems of one iteration of a decomposition algorithm.
+        All the jobs are submitted before any of them is waited on, so that the network and queue
+        waits of the individual solves overlap rather than add up.
+        @param inputDataList: the variable, solve-specific input data of each instance
+        @type inputDataList: list<OPLCollector>
+        @param solutionId: a prefix for the solution identifiers; the position of each instance in the list is appended to it
+        @type solutionId: String
+        @param fanout: the maximum number of jobs handled at the same time, beyond which connections are opened outside the pool of the client
+        @type fanout: int
+        @return: the solution collectors, in the order of inputDataList
+        '''
+        with ThreadPoolExecutor(max_workers=fanout) as executor:
+            futures = [executor.submit(self.submit, inputData) for inputData in inputDataList]
+        jobids = []
+        failure = None
+        for future in futures:
+            try:
+                jobids.append(future.result())
+            except Exception as e:
+                if failure is None:
+                    failure = e
+        if failure is not None:
+            # the jobs that were submitted are executing, and would otherwise run on the solve service and never be deleted
+            for jobid in jobids:
+                self._deleteJob(jobid, kill=True)
+            raise failure
+        return self.gather(jobids, solutionId, fanout)
+
+    def submit(self, inputData=None):
+        '''
+        Submits a job for an optimization problem instance to the DOCloud solve service (Oaas)
+        without waiting for it to complete.
+        Note: this method will set a new destination for the JSON serialization of the input data.
+        @param inputData: the variable, solve-specific input data (None or an empty collector if not used)
+        @type inputData: OPLCollector
+        @return: the id of the submitted job, to be passed to fetch or gather
         '''
-        inputs = []
         if self.model is None:
             raise ValueError("A model attachment must be provided to the optimizer")
+        templateJob, template = self._getTemplateJob()
+        with contextlib.ExitStack() as streams:
+            inputs = self._buildVariableInputs(inputData, streams)
+            if template is not None:
+                overrides = {}
+                if inputs:  # is not empty
+                    overrides["attachments"] = [{"name": i["name"]} for i in inputs]
+                try:
+                    jobid = self.jobclient.copy_job(template, shallow=True, **overrides)
+                except DOcloudException as e:
+                    if _httpStatus(e) not in _COPY_UNSUPPORTED_STATUSES:
+                        raise
+                    # Stop copying the template, but keep its job until exit: copies made by other threads may still read it
+                    templateJob.copyable = False
+                    template = None
+            if template is None:
+                return self.jobclient.submit(
+                    input=self._buildConstantInputs(streams) + inputs,
+                    gzip=True,
+                    parameters={"oaas.resultsFormat": "JSON"})
+            for i in inputs:
+                self.jobclient.upload_job_attachment(jobid, i["name"], file=i["file"], gzip=True)
+        self.jobclient.execute_job(jobid)
+        return jobid
+
+    def gather(self, jobids, solutionId="", fanout=_POOL_SIZE):
+        '''
+        Waits concurrently for several submitted jobs and retrieves their solutions.
+        @param jobids: the ids returned by submit
+        @type jobids: list<String>
+        @param solutionId: a prefix for the solution identifiers; the position of each job in the list is appended to it
+        @type solutionId: String
+        @param fanout: the maximum number of jobs waited on at the same time
+        @type fanout: int
+        @return: the solution collectors, in the order of jobids
+        '''
+        self._discardLazySolution()
+        if not jobids:  # is empty
+            self.solveStatuses = []
+            return []
+        solutionIds = [solutionId + str(i) for i in range(len(jobids))]
+        with ThreadPoolExecutor(max_workers=min(fanout, len(jobids))) as executor:
+            results = list(executor.map(self._fetch, jobids, solutionIds))
+        # recorded here rather than by the worker threads, so that the statuses and history follow the order of jobids
+        self.solveStatuses = [solveStatus for solution, solveStatus, keptJob in results]
+        solutions = [solution for solution, solveStatus, keptJob in results]
+        self.history.extend(solution for solution in solutions if solution is not None)
+        return solutions
+
+    def fetch(self, jobid, solutionId="", log=None):
+        '''
+        Waits for a submitted job to complete and maps its results to an instance of an OPL Collector.
+        The job is deleted from the solve service afterwards.
+        @param jobid: the id returned by submit
+        @type jobid: String
+        @param solutionId: an identifier for the solution, used in iterative algorithms (set to empty string if not needed)
+        @type solutionId: String
+        @param log: the file name where to save the last 64KB of the solver log (set to None if not needed)
+        @type log: String
+        @return: a solution collector, or None if the job did not process successfully
+        '''
+        self._discardLazySolution()
+        solution, self.solveStatus, keptJob = self._fetch(jobid, solutionId, log)
+        if solution is not None:
+            self.history.append(solution)
+        return solution
+
+    def _fetch(self, jobid, solutionId, log=None, lazy=False):
+        '''
+        Waits for a submitted job to complete and maps its results to an instance of an OPL Collector,
+        without recording the solve status or the solution on this optimizer, so that it can run on several threads at once.
+        The parameters are those of fetch, plus lazy, which is used only by solve.
+        @param lazy: if True, the solution is not downloaded and the job is kept, so that the caller can download it later
+        @type lazy: boolean
+        @return: the solution collector, or None, the solve status of the job, and whether the job was kept
+        '''
+        solution = None
+        solveStatus = JobSolveStatus.UNKNOWN
+        keepJob = False
+        ended = False
+        try:
+            status = self._waitForCompletion(jobid, waittime=300)  # seconds
+            ended = True
+            if log is not None:
+                with open(log, "wb") as logFile:
+                    logFile.write(self.jobclient.download_job_log_tail(jobid))
+            if status == JobExecutionStatus.PROCESSED:
+                jobInfo = self.jobclient.get_job(jobid)
+                solveStatus = jobInfo.get(
+                    'solveStatus')  # INFEASIBLE_SOLUTION or UNBOUNDED_SOLUTION or OPTIMAL_SOLUTION or...
+                if lazy:
+                    keepJob = True
+                else:
+                    solution = self._loadSolution(jobid, solutionId)
+            elif status == JobExecutionStatus.FAILED:
+                # get failure message if defined
+                message = ""
+                failureInfo = self.jobclient.get_failure_info(jobid)
+                if failureInfo is not None:
+                    message = failureInfo.get("message", "")
+                print("Failed " + message)
+            else:
+                print("Job Status: " + str(status))
+        finally:
+            if not keepJob:
+                # a job that is not known to have ended, e.g. after the timeout, is still running and must be killed
+                self._deleteJob(jobid, kill=not ended)
+
+        return solution, solveStatus, keepJob
+
+    def _loadSolution(self, jobid, solutionId):
+        '''
+        Downloads the results of a processed job and maps them to an instance of an OPL Collector.
+        @param jobid: the id of the job
+        @type jobid: String
+        @param solutionId: an identifier for the solution
+        @type solutionId: String
+        @return: a solution collector
+        '''
+        # the collector parses the results as they arrive, without a copy of the whole download in memory
+        response = self.jobclient.download_job_attachment_as_stream(jobid, "solution.json")
+        try:
+            response.raw.decode_content = True
+            solution = (OPLCollector(self.getName() + "Result" + solutionId, self.resultDataModel)).setJsonSource(
+                response.raw).fromJSON()
+        finally:
+            response.close()
+        return solution
+
+    def _deleteJob(self, jobid, kill=False):
+        '''
+        Deletes a job from the solve service in the background, since the caller does not depend on the deletion
+        and need not wait for its round trip.
+        @param jobid: the id of the job
+        @type jobid: String
+        @param kill: if True, the job may still be running and is killed before it is deleted
+        @type kill: boolean
+        '''
+        _deleteJobInBackground(self.jobclient, jobid, kill)
+
+    def _waitForCompletion(self, jobid, waittime):
+        '''
+        Polls the execution status of a job until it has ended.
+        The polling interval starts short, so that quick solves return promptly, and doubles up to a cap,
+        so that long solves do not flood the solve service with status requests.
+        @param jobid: the id returned by submit
+        @type jobid: String
+        @param waittime: the maximum time to wait, in seconds
+        @type waittime: float
+        @return: the execution status of the job
+        @raise DOcloudInterruptedException if the job has not ended within waittime
+        '''
+        timeLimit = time.time() + waittime
+        delay = 0.05  # seconds
+        status = self.jobclient.get_execution_status(jobid)
+        while not JobExecutionStatus.isEnded(status):
+            if time.time() > timeLimit:
+                raise DOcloudInterruptedException("Timeout after " + str(waittime), jobid=jobid)
+            time.sleep(delay)
+            delay = min(delay * 2, 5.0)
+            status = self.jobclient.get_execution_status(jobid)
+        return status
+
+    def _getTemplateJob(self):
+        '''
+        Returns a job, never executed, that holds the model and the constant data on the solve service.
+        Each solve copies it shallowly, so that only the variable input data is uploaded from solve to solve.
+        The template is created on the second submit of a problem, so that a one-off solve does not leave a job behind,
+        and is shared by all the optimizers with the same credentials, model, and constant data.
+        @return: the template and the id of its job, or None if the submit must upload the model and constant data itself
+        '''
+        templateKey = (self.jobclient.url, self.jobclient.api_key, self.model.getName(), self.model.getDigest(),
+                       tuple(sorted(self.attachments.items())))
+        with _templateJobsLock:
+            templateJob = _templateJobs.get(templateKey)
+            if templateJob is None:
+                _templateJobs[templateKey] = _TemplateJob(self.jobclient)
+                return _templateJobs[templateKey], None
+        with templateJob.lock:
+            if templateJob.jobid is None and templateJob.copyable:
+                templateJob.jobid = self._createTemplateJob()
+            return templateJob, templateJob.jobid if templateJob.copyable else None
+
+    def _createTemplateJob(self):
+        '''
+        Creates a job, never executed, and uploads the model and the constant data to it.
+        The job is created before the uploads, so that it can be deleted if one of them fails.
+        @return: the id of the job, or None if it could not be built, in which case the submit uploads the model and constant data itself
+        '''
+        with contextlib.ExitStack() as streams:
+            inputs = self._buildConstantInputs(streams)
+            try:
+                jobid = self.jobclient.create_job(attachments=[{"name": i["name"]} for i in inputs],
+                                                  parameters={"oaas.resultsFormat": "JSON"})
+            except _requestErrors as e:
+                print("Could not create a template job: " + str(e))
+                return None
+            try:
+                for i in inputs:
+                    self.jobclient.upload_job_attachment(jobid, i["name"], file=i["file"], gzip=True)
+            except _requestErrors as e:
+                print("Could not upload template job " + jobid + ": " + str(e))
+                self._deleteJob(jobid)
+                return None
+        return jobid
+
+    def _buildConstantInputs(self, streams):
+        '''
+        Assembles the job attachments that do not vary from solve to solve: the model and the constant data.
+        @param streams: the owner of the streams opened for the attachments, which closes them once they are uploaded
+        @type streams: contextlib.ExitStack
+        @return: the attachments
+        '''
+        inputs = []
         if self.model:  # is not empty
-            stream = self.model.toStream()
+            stream = streams.enter_context(self.model.toStream())
             inputs.append({"name": self.model.getName(), "file": stream})
-            self.streamsRegistry.append(stream)
         if self.attachments:  # is not empty
             for f in self.attachments:
-                stream = urllib.FancyURLopener(self.attachments[f])
+                stream = streams.enter_context(_openURL(self.attachments[f]))
                 inputs.append({"name": f, "file": stream})
-                self.streamsRegistry.append(stream)
-        if inputData is not None:
-            outStream = cStringIO.StringIO()
-            inputData.setJsonDestination(outStream).toJSON()
-            inStream = cStringIO.StringIO(outStream.getvalue())
-            inputs.append({"name": inputData.getName() + ".json", "file": inStream})
-            self.streamsRegistry.extend([outStream, inStream])
-
-        response = self.jobclient.execute(
-            input=inputs,
-            output="results.json",
-            load_solution=True,
-            log="solver.log",
-            gzip=True,
-            waittime=300,  # seconds
-            delete_on_completion=False)
-
-        self.jobid = response.jobid
-
-        status = self.jobclient.get_execution_status(self.jobid)
-        if status == JobExecutionStatus.PROCESSED:
-            results = cStringIO.StringIO(response.solution)
-            self.streamsRegistry.append(results)
-            self.solveStatus = response.job_info.get(
-                'solveStatus')  # INFEASIBLE_SOLUTION or UNBOUNDED_SOLUTION or OPTIMAL_SOLUTION or...
-            solution = (OPLCollector(self.getName() + "Result" + solutionId, self.resultDataModel)).setJsonSource(
-                results).fromJSON()
-            self.history.append(solution)
-        elif status == JobExecutionStatus.FAILED:
-            # get failure message if defined
-            message = ""
-            if (response.getJob().getFailureInfo() != None):
-                message = response.getJob().getFailureInfo().getMessage()
-            print("Failed " + message)
-        else:
-            print("Job Status: " + status)
-
-        for s in self.streamsRegistry:
-            s.close();
-        self.jobclient.delete_job(self.jobid);
+        return inputs
 
-        return solution
+    def _buildVariableInputs(self, inputData, streams):
+        '''
+        Assembles the job attachment for the variable input data.
+        @param inputData: the variable, solve-specific input data (None or an empty collector if not used)
+        @type inputData: OPLCollector
+        @param streams: the owner of the streams opened for the attachments, which closes them once they are uploaded
+        @type streams: contextlib.ExitStack
+        @return: the attachments, which are none if there is no variable input data
+        '''
+        inputs = []
+        if inputData is not None and not inputData.isEmpty():  # an empty collector adds nothing to the constant data
+            # the collector writes JSON text, which is encoded into one buffer that is then rewound and read by the upload;
+            # a collector that encodes the JSON itself can write the bytes to the buffer attribute of its destination
+            stream = streams.enter_context(io.BytesIO())
+            destination = io.TextIOWrapper(stream, encoding="utf-8", write_through=True)
+            inputData.setJsonDestination(destination).toJSON()
+            destination.flush()
+            destination.detach()  # so that discarding the wrapper does not close the buffer
+            stream.seek(0)
+            inputs.append({"name": inputData.getName() + ".json", "file": stream})
+        return inputs
 
     def getSolveStatus(self):
         """
@@ -215,6 +937,12 @@ class Optimizer(object):
         """
         return self.solveStatus
 
+    def getSolveStatuses(self):
+        '''
+        @return the solve statuses of the jobs of the last call to gather or solveMany, in the order of their jobs
+        '''
+        return self.solveStatuses
+
 
 # end class Optimizer
 
@@ -268,6 +996,8 @@ class ModelSource(object):
         if modelText is not None and not modelText:  # is empty
             raise ValueError("argument cannot be empty");
         self.modelText = modelText;
+        self._cachedBytes = None  # the concatenated model, read on first use
+        self._digest = None
 
     def getName(self):
         '''
@@ -285,15 +1015,37 @@ class ModelSource(object):
     def toStream(self):
         '''
          Concatenates the model components and creates an input file for reading them.
+         The components are read and concatenated only once; every call returns a new file over the same contents,
+         so that repeated solves do not fetch the model files again.
 
          @return a file
         '''
-        if self.dotMods:  # is not empty
-            result = fileinput.input((urllib.FancyURLopener(f) for f in self.dotMods))
-            return result
-        if self.modelText:  # is not empty
-            result = cStringIO.StringIO("".join(self.modelText))
-            return result
-        raise ValueError("model source is empty")
+        return io.BytesIO(self._getBytes())
+
+    def getDigest(self):
+        '''
+         @return the SHA-256 digest of the concatenated model components, which identifies the model by its contents
+         @type String
+        '''
+        if self._digest is None:
+            self._digest = hashlib.sha256(self._getBytes()).hexdigest()
+        return self._digest
+
+    def _getBytes(self):
+        '''
+         @return the concatenated model components, read on the first call
+        '''
+        if self._cachedBytes is None:
+            if self.dotMods:  # is not empty
+                # the files are downloaded concurrently, so a composite model costs one round trip rather than one per file
+                with ThreadPoolExecutor(max_workers=len(self.dotMods)) as executor:
+                    bodies = list(executor.map(_readURL, self.dotMods))
+                self._cachedBytes = b"".join(bodies)
+            elif self.modelText:  # is not empty
+                self._cachedBytes = "".join(self.modelText).encode("utf-8")
+            else:
+                raise ValueError("model source is empty")
+        return self._cachedBytes
+
+    # end class ModelSource
 
-    # end class ModelSource
\ No newline at end of file